@@ -1,57 +1,207 @@
 import azure.functions as func
-from opencensus.ext.azure.log_exporter import AzureLogHandler
+from azure.monitor.opentelemetry import configure_azure_monitor
 import logging
 import os
-from azure.storage.blob import BlobServiceClient
-from azure.identity import DefaultAzureCredential
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
+from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
 import mimetypes
 from azure.keyvault.secrets import SecretClient
 import time
-import gzip
+import zlib
+import asyncio
 from datetime import datetime, timezone, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+# Upload limits enforced by validate_file
+MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.png': 'image/png',
+    '.pdf': 'application/pdf',
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+}
+ALLOWED_EXTENSIONS = tuple(MIME_TYPES)
+
+# Re-fetch secrets from Key Vault at most this often so rotated values are picked up
+SECRETS_TTL_SECONDS = 10 * 60
+# After a failed refresh, keep serving the cached secrets and retry this much later
+SECRETS_RETRY_SECONDS = 30
+
+# Blobs up to this size go up in a single PUT; larger ones are split into blocks of
+# MAX_BLOCK_SIZE. Uploads are capped at 50MB, so this keeps them to a handful of PUTs.
+MAX_SINGLE_PUT_SIZE = 8 * 1024 * 1024
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Formats that are already compressed; gzipping them costs CPU for no size win
+COMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.gz', '.zip', '.pdf', '.docx', '.xlsx', '.pptx')
+
+# Longest a backup or archive copy may stay pending before the file is skipped
+MAX_COPY_WAIT_SECONDS = 60
+
+# Upper bound on files the backup function works on at once
+MAX_CONCURRENT_FILES = 32
+
+# Blobs requested per listing page; also bounds how many listed blobs wait in memory
+LIST_PAGE_SIZE = 500
+
+# App settings, resolved once per worker instead of on every invocation
+UPLOAD_CONTAINER = os.environ["UPLOAD_CONTAINER_NAME"]
+BACKUP_CONTAINER = os.environ["BACKUP_CONTAINER_NAME"]
+ARCHIVE_CONTAINER = os.environ["ARCHIVE_CONTAINER_NAME"]
+RETENTION = timedelta(days=int(os.environ["RETENTION_DAYS"]))
+
+_secrets_cache = None
+_secrets_fetched_at = 0.0
+# One refresh at a time, on its own thread so it never queues behind compression work
+_secrets_refresh_lock = asyncio.Lock()
+_secrets_executor = ThreadPoolExecutor(max_workers=1)
+
+_blob_service_client = None
+_blob_service_conn_str = None
+_container_clients = {}
+# In-flight invocations per client, so a client replaced on rotation is not closed under them
+_blob_service_users = {}
+
+def get_credential():
+    # Inside the Functions host go straight to managed identity rather than walking
+    # the DefaultAzureCredential chain; keep the chain for local development
+    if os.environ.get("WEBSITE_INSTANCE_ID"):
+        return ManagedIdentityCredential(client_id=os.environ.get("AZURE_CLIENT_ID"))
+    return DefaultAzureCredential()
+
+# Shared across refreshes so the credential's token cache survives between them
+_credential = get_credential()
+
+def secrets_expired():
+    return _secrets_cache is None or time.monotonic() - _secrets_fetched_at >= SECRETS_TTL_SECONDS
 
 def get_secrets_from_keyvault():
+    global _secrets_cache, _secrets_fetched_at
+
+    if not secrets_expired():
+        return _secrets_cache
+
     vault_url = os.environ["AZURE_KEY_VAULT_URL"]
     
     try:
-        credential = DefaultAzureCredential()
-        client = SecretClient(vault_url=vault_url, credential=credential)
+        client = SecretClient(vault_url=vault_url, credential=_credential)
         
-        # Get both secrets
-        storage_connection_string = client.get_secret("AzureStorageConnectionString").value
-        app_insights_connection_string = client.get_secret("ApplicationInsightsConnectionString").value
+        # Get both secrets in parallel
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            storage_future = executor.submit(client.get_secret, "AzureStorageConnectionString")
+            app_insights_future = executor.submit(client.get_secret, "ApplicationInsightsConnectionString")
+            storage_connection_string = storage_future.result().value
+            app_insights_connection_string = app_insights_future.result().value
         
-        return storage_connection_string, app_insights_connection_string
+        _secrets_cache = (storage_connection_string, app_insights_connection_string)
+        _secrets_fetched_at = time.monotonic()
+        return _secrets_cache
     except Exception as e:
         logging.error(f"Error retrieving secrets from Key Vault: {str(e)}")
         raise
 
 # Setup logging with Application Insights
-storage_conn_str, app_insights_conn_str = get_secrets_from_keyvault()
+_, app_insights_conn_str = get_secrets_from_keyvault()
+# Records are exported in batches by the OpenTelemetry SDK on a background thread.
+# Only logs are exported, as before; tracing, metrics and the Azure SDK/HTTP
+# instrumentations would add a span to every blob call.
+configure_azure_monitor(
+    connection_string=app_insights_conn_str,
+    logger_name=__name__,
+    disable_tracing=True,
+    disable_metrics=True,
+    instrumentation_options={
+        "azure_sdk": {"enabled": False},
+        "requests": {"enabled": False},
+        "urllib": {"enabled": False},
+        "urllib3": {"enabled": False}
+    }
+)
 logger = logging.getLogger(__name__)
-logger.addHandler(AzureLogHandler(connection_string=app_insights_conn_str))
 
 logging.getLogger().setLevel(logging.INFO)
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-def init_blob_service():
-    storage_conn_str, _ = get_secrets_from_keyvault()
-    return BlobServiceClient.from_connection_string(storage_conn_str)
+async def refresh_secrets():
+    # Only the cold-start fetch is synchronous; later refreshes run on a worker thread
+    # so the blocking Key Vault calls never stall the event loop
+    global _secrets_fetched_at
 
-def validate_file(file):
-    max_size = 50 * 1024 * 1024  # 50MB
-    allowed_types = ['.jpg', '.png', '.pdf', '.docx']
-    
-    if file.content_length > max_size:
-        return False, "File too large"
+    if not secrets_expired():
+        return _secrets_cache
+
+    async with _secrets_refresh_lock:
+        # Another invocation may have refreshed while this one waited for the lock
+        if secrets_expired():
+            try:
+                await asyncio.get_running_loop().run_in_executor(_secrets_executor, get_secrets_from_keyvault)
+            except Exception as e:
+                # The cached secrets still work, so keep using them rather than failing requests
+                logger.error(f"Key Vault refresh failed, using cached secrets: {str(e)}")
+                _secrets_fetched_at = time.monotonic() - SECRETS_TTL_SECONDS + SECRETS_RETRY_SECONDS
+    return _secrets_cache
+
+@asynccontextmanager
+async def blob_service():
+    # One client per connection string so the HTTP pipeline and connection pool are reused.
+    # Async functions all run on the worker's event loop, so the async client can be shared.
+    global _blob_service_client, _blob_service_conn_str
+
+    storage_conn_str, _ = await refresh_secrets()
+    if storage_conn_str != _blob_service_conn_str:
+        # New or rotated connection string: swap clients and drop the old container clients
+        old_client = _blob_service_client
+        _blob_service_client = BlobServiceClient.from_connection_string(
+            storage_conn_str,
+            max_single_put_size=MAX_SINGLE_PUT_SIZE,
+            max_block_size=MAX_BLOCK_SIZE
+        )
+        _blob_service_conn_str = storage_conn_str
+        _container_clients.clear()
+        if old_client is not None and old_client not in _blob_service_users:
+            await old_client.close()
+
+    client = _blob_service_client
+    _blob_service_users[client] = _blob_service_users.get(client, 0) + 1
+    try:
+        yield client
+    finally:
+        _blob_service_users[client] -= 1
+        if not _blob_service_users[client]:
+            del _blob_service_users[client]
+            # A replaced client is closed once the last invocation using it is done
+            if client is not _blob_service_client:
+                await client.close()
+
+def get_container_client(blob_service_client, container_name):
+    # Container clients are only cached for the current service client
+    if blob_service_client is not _blob_service_client:
+        return blob_service_client.get_container_client(container_name)
+    if container_name not in _container_clients:
+        _container_clients[container_name] = blob_service_client.get_container_client(container_name)
+    return _container_clients[container_name]
+
+def get_stream_size(stream):
+    # Multipart parts rarely carry their own Content-Length, so measure the spooled stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def validate_file(file, size_bytes):
+    # Returns the matched extension, or None and the reason the file was rejected
+    if size_bytes > MAX_FILE_SIZE:
+        return None, "File too large"
     
-    file_ext = os.path.splitext(file.filename)[1].lower()
-    if file_ext not in allowed_types:
-        return False, "File type not allowed"
+    filename = file.filename.lower()
+    if not filename.endswith(ALLOWED_EXTENSIONS):
+        return None, "File type not allowed"
         
-    return True, ""
+    # Safe once the check passes, including for a bare name like '.png'
+    return '.' + filename.rpartition('.')[2], ""
 
 @app.route(route="upload", methods=["POST"])
 async def upload(req: func.HttpRequest) -> func.HttpResponse:
@@ -61,38 +211,58 @@ async def upload(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse("No file uploaded", status_code=400)
             
         # Validate file
-        is_valid, error = validate_file(file)
-        if not is_valid:
+        size_bytes = get_stream_size(file.stream)
+        file_ext, error = validate_file(file, size_bytes)
+        if file_ext is None:
             logger.warning(f"Invalid file upload attempt: {error}")
             return func.HttpResponse(f"Invalid file: {error}", status_code=400)
             
         filename = file.filename
-        file_data = file.read()
-        
-        # Get storage connection string
-        storage_conn_str, _ = get_secrets_from_keyvault()
         
-        # Upload to blob storage
-        blob_service_client = BlobServiceClient.from_connection_string(storage_conn_str)
-        container_client = blob_service_client.get_container_client("upload-cont")
-        blob_client = container_client.get_blob_client(filename)
-        blob_client.upload_blob(file_data, overwrite=True)
+        # Stream the upload to blob storage instead of reading it into memory
+        async with blob_service() as blob_service_client:
+            container_client = get_container_client(blob_service_client, UPLOAD_CONTAINER)
+            blob_client = container_client.get_blob_client(filename)
+            await blob_client.upload_blob(file.stream, length=size_bytes, overwrite=True, max_concurrency=4)
         
         # Log metadata to Application Insights
         metadata = {
-            'filename': filename,
-            'size_bytes': len(file_data),
-            'content_type': mimetypes.guess_type(filename)[0],
+            'file_name': filename,
+            'size_bytes': size_bytes,
+            'content_type': MIME_TYPES[file_ext],
             'upload_timestamp': datetime.now(timezone.utc).isoformat()
         }
-        logger.info('File upload successful', extra={'custom_dimensions': metadata})
+        logger.info('File upload successful', extra=metadata)
         
         return func.HttpResponse(f"File uploaded successfully: {filename}", status_code=200)
     except Exception as e:
         logger.error(f"Upload failed: {str(e)}")
         return func.HttpResponse(f"Upload failed: {str(e)}", status_code=500)
 
-def process_single_file(blob_service_client, file_name, upload_container, backup_container, archive_container):
+async def gzip_chunks(download_stream):
+    # wbits=31 makes zlib emit a gzip header and trailer. Compression runs on a worker
+    # thread (zlib releases the GIL) so it does not stall other coroutines on the loop.
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    async for chunk in download_stream.chunks():
+        compressed = await asyncio.to_thread(compressor.compress, chunk)
+        if compressed:
+            yield compressed
+    yield await asyncio.to_thread(compressor.flush)
+
+async def wait_for_copy(blob_client, copy):
+    # Same-account copies usually finish immediately, but the source must not be
+    # deleted while a copy is still pending
+    status = copy['copy_status']
+    deadline = time.monotonic() + MAX_COPY_WAIT_SECONDS
+    while status == 'pending':
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Copy to {blob_client.blob_name} still pending after {MAX_COPY_WAIT_SECONDS} seconds")
+        await asyncio.sleep(1)
+        status = (await blob_client.get_blob_properties()).copy.status
+    if status != 'success':
+        raise RuntimeError(f"Copy to {blob_client.blob_name} ended with status: {status}")
+
+async def process_single_file(blob_service_client, file_name, upload_container, backup_container, archive_container):
     try:
         # Copy to backup container
         source_blob = blob_service_client.get_blob_client(
@@ -105,104 +275,114 @@ def process_single_file(blob_service_client, file_name, upload_container, backup
             blob=file_name
         )
         
-        backup_blob.start_copy_from_url(source_blob.url)
+        await wait_for_copy(backup_blob, await backup_blob.start_copy_from_url(source_blob.url))
         
         # Check retention period and archive if needed
-        blob_properties = source_blob.get_blob_properties()
+        blob_properties = await source_blob.get_blob_properties()
         creation_time = blob_properties.creation_time
-        retention_days = int(os.environ["RETENTION_DAYS"])
         
-        if datetime.now(timezone.utc) - creation_time > timedelta(days=retention_days):
-            # Download blob content
-            download_stream = source_blob.download_blob()
-            
-            # Compress content
-            compressed_content = gzip.compress(download_stream.readall())
-            
-            # Upload to archive container
-            archive_blob = blob_service_client.get_blob_client(
-                container=archive_container,
-                blob=f"{file_name}.gz"
-            )
-            archive_blob.upload_blob(compressed_content, overwrite=True)
+        if datetime.now(timezone.utc) - creation_time > RETENTION:
+            if file_name.lower().endswith(COMPRESSED_EXTENSIONS):
+                # Already compressed, so archive it as-is with a server-side copy
+                archive_blob = blob_service_client.get_blob_client(
+                    container=archive_container,
+                    blob=file_name
+                )
+                await wait_for_copy(archive_blob, await archive_blob.start_copy_from_url(source_blob.url))
+            else:
+                # Compress content as it downloads and stream it to the archive container.
+                # The blob keeps its name and is marked gzip-encoded so clients decompress it transparently.
+                download_stream = await source_blob.download_blob()
+                
+                archive_blob = blob_service_client.get_blob_client(
+                    container=archive_container,
+                    blob=file_name
+                )
+                await archive_blob.upload_blob(
+                    gzip_chunks(download_stream),
+                    overwrite=True,
+                    content_settings=ContentSettings(
+                        content_encoding="gzip",
+                        content_type=mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+                    )
+                )
             
             # Delete original blob
-            source_blob.delete_blob()
+            await source_blob.delete_blob()
             
         return True
         
     except Exception as e:
         return False
 
+async def process_and_log(blob_service_client, blob, start_time, upload_container, backup_container, archive_container):
+    success = await process_single_file(
+        blob_service_client,
+        blob.name,
+        upload_container,
+        backup_container,
+        archive_container
+    )
+
+    # Calculate file age in days from the listing, as archived blobs no longer exist
+    file_age = (datetime.now(timezone.utc) - blob.last_modified).days
+    
+    execution_time = time.time() - start_time
+    
+    metadata = {
+        'blob_name': blob.name,
+        'was_archived': file_age > RETENTION.days,
+        'processing_time': execution_time,
+        'file_age_days': file_age
+    }
+
+    if success:
+        logger.info(
+            f"Completed processing file: {blob.name}",
+            extra=metadata
+        )
+    else:
+        logger.error(
+            f"Failed to process file: {blob.name}",
+            extra=metadata
+        )
+
 @app.blob_trigger(arg_name="myblob", 
-                 path="upload-cont/{name}",
+                 path="%UPLOAD_CONTAINER_NAME%/{name}",
                  connection="AzureWebJobsStorage")
-def backup_function(myblob: func.InputStream):
+async def backup_function(myblob: func.InputStream):
     start_time = time.time()
     
-    blob_service_client = init_blob_service()
-    upload_container = os.environ["UPLOAD_CONTAINER_NAME"]
-    backup_container = os.environ["BACKUP_CONTAINER_NAME"]
-    archive_container = os.environ["ARCHIVE_CONTAINER_NAME"]
-    
-    # Get list of files to process
-    container_client = blob_service_client.get_container_client(upload_container)
-    blobs = container_client.list_blobs()
-    
-    # Process files in parallel using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        future_to_file = {
-            executor.submit(
-                process_single_file,
-                blob_service_client,
-                blob.name,
-                upload_container,
-                backup_container,
-                archive_container
-            ): blob.name for blob in blobs
-        }
-        
-        retention_days = int(os.environ["RETENTION_DAYS"])
+    async with blob_service() as blob_service_client:
+        # List files page by page and hand them to workers as each page arrives
+        container_client = get_container_client(blob_service_client, UPLOAD_CONTAINER)
+        queue = asyncio.Queue(maxsize=LIST_PAGE_SIZE)
 
-        for future in as_completed(future_to_file):
-            file_name = future_to_file[future]
-            try:
-                # Get blob properties to calculate file age
-                blob_client = container_client.get_blob_client(file_name)
-                properties = blob_client.get_blob_properties()
-                last_modified = properties.last_modified
-                
-                # Calculate file age in days
-                file_age = (datetime.now(timezone.utc) - last_modified).days
-                
-                execution_time = time.time() - start_time
-                
-                # Update the metadata dictionary
-                metadata = {
-                    'blob_name': file_name,
-                    'was_archived': file_age > retention_days,
-                    'processing_time': execution_time,
-                    'file_age_days': file_age
-                }
-
-                # Update logging calls
-                success = future.result()
-                if success:
-                    logger.info(
-                        f"Completed processing file: {file_name}",
-                        extra=metadata
-                    )
-                else:
-                    logger.error(
-                        f"Failed to process file: {file_name}",
-                        extra=metadata
-                    )
-            except Exception as e:
-                logger.error(
-                    f"Error processing {file_name}: {str(e)}",
-                    extra=metadata
+        async def list_files():
+            async for page in container_client.list_blobs(results_per_page=LIST_PAGE_SIZE).by_page():
+                async for blob in page:
+                    await queue.put(blob)
+            for _ in range(MAX_CONCURRENT_FILES):
+                await queue.put(None)
+
+        async def worker():
+            while (blob := await queue.get()) is not None:
+                await process_and_log(
+                    blob_service_client,
+                    blob,
+                    start_time,
+                    UPLOAD_CONTAINER,
+                    BACKUP_CONTAINER,
+                    ARCHIVE_CONTAINER
                 )
 
+        # If listing fails the task group cancels the workers and waits for them, so no
+        # copies or deletes keep running after the invocation has returned
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(list_files())
+            for _ in range(MAX_CONCURRENT_FILES):
+                task_group.create_task(worker())
+
     end_time = time.time()
     logger.info(
         f"Backup function completed. Total processing time: {end_time - start_time} seconds"